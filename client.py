@@ -2,18 +2,27 @@
 Client script to test the ASV Comparison API.
 This script demonstrates how to interact with the deployed API.
 """
-import requests
+import asyncio
+import importlib.util
 import json
+import time
+import httpx
 
 # API base URL - change this to your deployed URL
 BASE_URL = "http://localhost:8000"  # For local testing
 # BASE_URL = "https://your-app-name.onrender.com"  # For deployed version
 
+# HTTP/2 needs the optional h2 package (pip install "httpx[http2]")
+HTTP2 = importlib.util.find_spec("h2") is not None
+
+# One persistent connection reused by every test instead of a new handshake per request
+SESSION = httpx.Client(base_url=BASE_URL, http2=HTTP2, timeout=30)
+
 def test_api_health():
     """Test the health endpoint."""
     print("=== Testing Health Endpoint ===")
     try:
-        response = requests.get(f"{BASE_URL}/health")
+        response = SESSION.get("/health")
         print(f"Status Code: {response.status_code}")
         print(f"Response: {json.dumps(response.json(), indent=2)}")
         print()
@@ -25,7 +34,7 @@ def test_database_info():
     """Test the database info endpoint."""
     print("=== Testing Database Info Endpoint ===")
     try:
-        response = requests.get(f"{BASE_URL}/database/info")
+        response = SESSION.get("/database/info")
         print(f"Status Code: {response.status_code}")
         print(f"Response: {json.dumps(response.json(), indent=2)}")
         print()
@@ -46,7 +55,7 @@ def test_single_sequence_prediction():
     }
     
     try:
-        response = requests.post(f"{BASE_URL}/predict", json=payload)
+        response = SESSION.post("/predict", json=payload)
         print(f"Status Code: {response.status_code}")
         print(f"Payload sent: {json.dumps(payload, indent=2)}")
         print(f"Response: {json.dumps(response.json(), indent=2)}")
@@ -65,7 +74,7 @@ def test_short_sequence():
     }
     
     try:
-        response = requests.post(f"{BASE_URL}/predict", json=payload)
+        response = SESSION.post("/predict", json=payload)
         print(f"Status Code: {response.status_code}")
         print(f"Payload sent: {json.dumps(payload, indent=2)}")
         print(f"Response: {json.dumps(response.json(), indent=2)}")
@@ -87,7 +96,7 @@ def test_different_sequence():
     }
     
     try:
-        response = requests.post(f"{BASE_URL}/predict", json=payload)
+        response = SESSION.post("/predict", json=payload)
         print(f"Status Code: {response.status_code}")
         print(f"Payload sent: {json.dumps(payload, indent=2)}")
         print(f"Response: {json.dumps(response.json(), indent=2)}")
@@ -118,7 +127,7 @@ def test_fasta_upload():
             files = {"file": ("test_query.fasta", f, "text/plain")}
             data = {"top_k": 3}
             
-            response = requests.post(f"{BASE_URL}/predict/fasta", files=files, data=data)
+            response = SESSION.post("/predict/fasta", files=files, data=data)
             print(f"Status Code: {response.status_code}")
             print(f"Response: {json.dumps(response.json(), indent=2)}")
             print()
@@ -126,11 +135,57 @@ def test_fasta_upload():
         print(f"Error: {e}")
         print()
 
+# Benchmark request bodies, serialized up front so the loop measures the server rather than
+# client-side JSON encoding. Each request gets a differently rotated sequence so it misses the
+# server's result cache and is actually scored
+BENCHMARK_SEQUENCE = "TACGTAGGGGGCAAGCGTTATCCGGATTTACTGGGTGTAAAGGGAGCGTAGACGGTGAGTTAAGTCTGAAGTAAAGGCAGTGGCTCAACCACTGTACGTGTTGGAAACTGACTCACTTGAGTGCAGAAGAGGAGAGTGGAACTCCATGTGTAGCGGTGAAATGCGTAGATATATGGAGGAACACCAGTGGCGAAGGCGACTCTCTGGTCTGTAACTGACGCTGAGGCGCGAAAGCGTGGGGAGCAAACAGG"
+JSON_HEADERS = {"Content-Type": "application/json"}
+
+def _benchmark_payloads(n_requests):
+    """Distinct pre-encoded /predict bodies, one per request."""
+    payloads = []
+    for i in range(n_requests):
+        shift = i % len(BENCHMARK_SEQUENCE)
+        sequence = BENCHMARK_SEQUENCE[shift:] + BENCHMARK_SEQUENCE[:shift]
+        # top_k varies too once every rotation has been used, so bodies stay unique
+        top_k = 3 + i // len(BENCHMARK_SEQUENCE)
+        payloads.append(json.dumps({"sequence": sequence, "top_k": top_k}).encode())
+    return payloads
+
+async def _concurrent_predictions(payloads):
+    async with httpx.AsyncClient(base_url=BASE_URL, http2=HTTP2, timeout=30) as client:
+        return await asyncio.gather(*[
+            client.post("/predict", content=payload, headers=JSON_HEADERS) for payload in payloads
+        ])
+
+def benchmark_concurrent_predictions(n_requests=100):
+    """
+    Send concurrent prediction requests and report throughput.
+    
+    With HTTP/2 the requests are multiplexed over one connection; over HTTP/1.1 the
+    client opens a pool of connections. Every request body is distinct, so the timing
+    covers scoring rather than hits in the server's result cache.
+    """
+    print(f"=== Benchmarking {n_requests} Concurrent Predictions ===")
+    payloads = _benchmark_payloads(n_requests)
+    
+    try:
+        start = time.perf_counter()
+        responses = asyncio.run(_concurrent_predictions(payloads))
+        elapsed = time.perf_counter() - start
+        ok = sum(response.status_code == 200 for response in responses)
+        print(f"Successful: {ok}/{n_requests}")
+        print(f"Elapsed: {elapsed:.2f} s ({n_requests / elapsed:.1f} requests/s)")
+        print()
+    except Exception as e:
+        print(f"Error: {e}")
+        print()
+
 def main():
     """Run all tests."""
     print("ASV Comparison API Client Test")
     print("=" * 50)
-    print(f"Testing API at: {BASE_URL}")
+    print(f"Testing API at: {BASE_URL} (HTTP/2: {HTTP2})")
     print()
     
     # Run all tests
@@ -140,6 +195,7 @@ def main():
     test_short_sequence()
     test_different_sequence()
     test_fasta_upload()
+    benchmark_concurrent_predictions()
     
     print("All tests completed!")
 
@@ -2,13 +2,16 @@
 ASV Sequence Comparison API
 A simple FastAPI service for comparing ASV sequences using k-mer vectorization.
 """
+import asyncio
 import logging
+import os
 import sys
 import traceback
-from fastapi import FastAPI, File, UploadFile, HTTPException
+from fastapi import FastAPI, File, UploadFile, HTTPException, Query
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import JSONResponse
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 from typing import Optional
 
 # Configure logging
@@ -48,11 +51,83 @@ app.add_middleware(
 # Global variables
 reference_db = None
 query_engine = None
+query_batcher = None
+batcher_task = None
+
+DATABASE_PATH = "reference_db.npz"
+LEGACY_DATABASE_PATH = "reference_db.pkl"
+
+# Micro-batching of /predict requests
+MAX_BATCH = 32
+MAX_WAIT_MS = 5
+
+# Approximate (HNSW) search is opt-in: with ASV_ANN_SEARCH=1 (and hnswlib installed) it is
+# used for databases at least ANN_MIN_SEQUENCES large, and /predict scores become approximate
+ANN_ENABLED = os.environ.get("ASV_ANN_SEARCH", "").lower() in ("1", "true", "yes")
+ANN_MIN_SEQUENCES = 1000
+ANN_EF = 50
+
+class QueryBatcher:
+    """
+    Collects concurrent single-sequence queries and scores them together.
+    
+    Requests are queued with a future; a background task drains up to max_batch
+    of them (waiting at most max_wait_ms after the first), runs one batched query
+    in the thread pool and resolves each future with its own result.
+    """
+    
+    def __init__(self, engine, max_batch: int = MAX_BATCH, max_wait_ms: float = MAX_WAIT_MS):
+        self.engine = engine
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000
+        self.queue = asyncio.Queue()
+    
+    async def submit(self, sequence: str, top_k: int):
+        """Queue a query and wait for its result."""
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((sequence, top_k, future))
+        return await future
+    
+    async def run(self):
+        """Process queued queries until cancelled."""
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            
+            sequences, top_ks, futures = zip(*batch)
+            try:
+                results = await run_in_threadpool(self.engine.query_sequence_batch, list(sequences), list(top_ks))
+            except Exception:
+                # Rerun each query on its own so only the failing ones get the error
+                for sequence, top_k, future in batch:
+                    try:
+                        result = await run_in_threadpool(self.engine.query_single_sequence, sequence, top_k)
+                    except Exception as e:
+                        if not future.done():
+                            future.set_exception(e)
+                    else:
+                        if not future.done():
+                            future.set_result(result)
+                continue
+            
+            for future, result in zip(futures, results):
+                if not future.done():
+                    future.set_result(result)
 
 class SequenceQuery(BaseModel):
     """Model for single sequence query."""
     sequence: str
-    top_k: Optional[int] = 5
+    # None returns every match; negative values are rejected with a 422
+    top_k: Optional[int] = Field(5, ge=0)
 
 class SearchResult(BaseModel):
     """Model for search results."""
@@ -61,6 +136,28 @@ class SearchResult(BaseModel):
     similarity_score: float
     taxonomy: Optional[str] = None
 
+def prepare_database_file():
+    """
+    Write DATABASE_PATH if it does not exist yet, from the legacy pickle or the sample database.
+    
+    Meant to run once at build time (python main.py --prepare-db, see render.yaml) so
+    that parallel workers only read the file. Should a worker still have to create it,
+    save() replaces the file atomically, so workers loading it concurrently never see
+    a partial archive.
+    """
+    if os.path.exists(DATABASE_PATH):
+        return
+    
+    db = ReferenceDatabase(k=6)
+    if db.load(LEGACY_DATABASE_PATH):
+        db.save(DATABASE_PATH, compress=False)
+        logger.info(f"Legacy database converted to {DATABASE_PATH}")
+    else:
+        logger.info("No existing database found, creating sample database...")
+        db.create_sample_database()
+        db.save(DATABASE_PATH, compress=False)
+        logger.info("Sample database created and saved")
+
 def load_reference_database():
     """Load reference database from file."""
     global reference_db, query_engine
@@ -69,17 +166,30 @@ def load_reference_database():
         logger.info("Initializing reference database...")
         reference_db = ReferenceDatabase(k=6)
         
-        # Try to load existing database, otherwise create sample database
-        if not reference_db.load("reference_db.pkl"):
-            logger.info("No existing database found, creating sample database...")
-            reference_db.create_sample_database()
-            reference_db.save("reference_db.pkl")
-            logger.info("Sample database created and saved")
-        else:
+        # The database is saved uncompressed and memory-mapped so that multiple
+        # workers share a single copy of the reference matrix
+        if reference_db.load(DATABASE_PATH, mmap=True):
             logger.info("Existing database loaded successfully")
+        else:
+            prepare_database_file()
+            if not reference_db.load(DATABASE_PATH, mmap=True):
+                raise RuntimeError(f"Could not load {DATABASE_PATH}")
+            logger.info("Database loaded successfully")
+        
+        # The ANN index is not persisted; rebuild it for large databases when enabled
+        if ANN_ENABLED and len(reference_db) >= ANN_MIN_SEQUENCES:
+            try:
+                reference_db.build_index(ef=ANN_EF)
+                logger.info(f"HNSW index built over {len(reference_db)} sequences (ef={ANN_EF}), "
+                            "similarity results are approximate")
+            except ImportError:
+                logger.info("hnswlib not installed, using exact search")
+        else:
+            logger.info("Using exact search")
         
         # Initialize query engine
         query_engine = SequenceQueryEngine(reference_db)
+        query_engine.warmup()
         logger.info("Query engine initialized successfully")
         
     except Exception as e:
@@ -93,12 +203,27 @@ async def startup_event():
     try:
         logger.info("Starting up API...")
         load_reference_database()
-        logger.info(f"API initialized with {len(reference_db.sequences)} reference sequences")
+        start_query_batcher()
+        logger.info(f"API initialized with {len(reference_db)} reference sequences")
     except Exception as e:
         logger.error(f"Startup failed: {e}")
         logger.error(f"Traceback: {traceback.format_exc()}")
         raise
 
+def start_query_batcher():
+    """Start the background task that micro-batches /predict queries."""
+    global query_batcher, batcher_task
+    
+    query_batcher = QueryBatcher(query_engine)
+    batcher_task = asyncio.get_running_loop().create_task(query_batcher.run())
+    logger.info(f"Query batcher started (max_batch={MAX_BATCH}, max_wait_ms={MAX_WAIT_MS})")
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    """Stop the query batcher."""
+    if batcher_task is not None:
+        batcher_task.cancel()
+
 @app.get("/")
 async def root():
     """Root endpoint with API information."""
@@ -128,7 +253,10 @@ async def predict_sequence(query: SequenceQuery):
             logger.error("Query engine not initialized")
             raise HTTPException(status_code=503, detail="Service not ready - query engine not initialized")
         
-        result = query_engine.query_single_sequence(query.sequence, query.top_k)
+        # Reject invalid input before queueing, then score together with concurrent requests
+        query_engine.validate_sequence(query.sequence)
+        top_k = query_engine.resolve_top_k(query.top_k)
+        result = await query_batcher.submit(query.sequence, top_k)
         logger.info(f"Query completed successfully, found {result.get('matches_found', 0)} matches")
         return JSONResponse(content=result)
         
@@ -141,7 +269,7 @@ async def predict_sequence(query: SequenceQuery):
         raise HTTPException(status_code=500, detail=f"Prediction error: {str(e)}")
 
 @app.post("/predict/fasta")
-async def predict_fasta(file: UploadFile = File(...), top_k: int = 5):
+async def predict_fasta(file: UploadFile = File(...), top_k: int = Query(5, ge=0)):
     """
     Compare ASV sequences from a FASTA file against the reference database.
     """
@@ -157,7 +285,8 @@ async def predict_fasta(file: UploadFile = File(...), top_k: int = 5):
         content = await file.read()
         fasta_content = content.decode('utf-8')
         
-        result = query_engine.query_fasta_sequences(fasta_content, top_k)
+        # Run the CPU-bound scoring in the thread pool so the event loop keeps serving requests
+        result = await run_in_threadpool(query_engine.query_fasta_sequences, fasta_content, top_k)
         logger.info(f"FASTA query completed successfully, found {result.get('matches_found', 0)} matches")
         return JSONResponse(content=result)
         
@@ -173,7 +302,7 @@ async def predict_fasta(file: UploadFile = File(...), top_k: int = 5):
 async def get_database_info():
     """Get information about the reference database."""
     try:
-        if not reference_db:
+        if reference_db is None:
             logger.error("Reference database not loaded")
             raise HTTPException(status_code=500, detail="Reference database not loaded")
         
@@ -188,13 +317,13 @@ async def get_database_info():
 async def health_check():
     """Health check endpoint."""
     try:
-        if not reference_db or not query_engine:
+        if reference_db is None or query_engine is None:
             logger.warning("Health check failed - service not ready")
             raise HTTPException(status_code=503, detail="Service not ready")
         
         health_info = {
             "status": "healthy",
-            "reference_sequences": len(reference_db.sequences),
+            "reference_sequences": len(reference_db),
             "vectorizer_ready": reference_db.vectorizer is not None,
             "database_info": reference_db.get_info()
         }
@@ -207,5 +336,8 @@ async def health_check():
         raise HTTPException(status_code=500, detail=f"Health check failed: {str(e)}")
 
 if __name__ == "__main__":
-    import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    if "--prepare-db" in sys.argv[1:]:
+        prepare_database_file()
+    else:
+        import uvicorn
+        uvicorn.run(app, host="0.0.0.0", port=8000)
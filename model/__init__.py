@@ -1,4 +1,5 @@
 """Model package for k-mer vectorization."""
-from .kmer import KmerVectorizer, cosine_similarity
+from .kmer import KmerVectorizer, cosine_similarity, quantize_int8, sparse_gemv, sparse_gemv_i8
+from .cache import LRUCache, sequence_digest
 
-__all__ = ['KmerVectorizer', 'cosine_similarity']
+__all__ = ['KmerVectorizer', 'cosine_similarity', 'quantize_int8', 'sparse_gemv', 'sparse_gemv_i8', 'LRUCache', 'sequence_digest']
@@ -0,0 +1,60 @@
+"""
+Small in-memory caches for vectors and query results.
+"""
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+
+def sequence_digest(sequence) -> bytes:
+    """Fixed-size cache key for a (possibly long) sequence; str and bytes give the same key."""
+    if isinstance(sequence, str):
+        sequence = sequence.encode()
+    return hashlib.blake2b(sequence, digest_size=16).digest()
+
+
+class LRUCache:
+    """
+    Thread-safe least-recently-used cache with a bounded number of entries.
+    
+    With a ttl (in seconds), entries older than ttl are treated as missing.
+    """
+    
+    def __init__(self, maxsize=1024, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        # key -> (value, time stored)
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def __len__(self):
+        return len(self._data)
+    
+    def get(self, key, default=None):
+        """Return the cached value for key (marking it recently used), or default."""
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return default
+            value, stored_at = entry
+            if self.ttl is not None and time.monotonic() - stored_at >= self.ttl:
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+    
+    def put(self, key, value):
+        """Store value under key, evicting the least recently used entry when full."""
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._data[key] = (value, time.monotonic())
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+    
+    def clear(self):
+        """Drop all cached entries."""
+        with self._lock:
+            self._data.clear()
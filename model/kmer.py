@@ -3,44 +3,299 @@ K-mer vectorization module for DNA sequences.
 """
 import numpy as np
 import itertools
-from collections import Counter
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import cached_property
+from .cache import LRUCache, sequence_digest
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+# Byte -> base code lookup, matching the vocabulary order (A, T, C, G).
+# N is treated as A like tokenize() does; anything else is invalid (4).
+_LOOKUP = np.full(256, 4, dtype=np.uint8)
+_LOOKUP[[ord(c) for c in 'ATCGN']] = [0, 1, 2, 3, 0]
+_LOOKUP[[ord(c) for c in 'atcgn']] = [0, 1, 2, 3, 0]
+# Built once at import and shared by every vectorizer (exposed as KmerVectorizer.BASE_LUT)
+_LOOKUP.flags.writeable = False
+# Base code -> upper-case ASCII byte ('?' marks an invalid base)
+_BASES = np.frombuffer(b'ATCG?', dtype=np.uint8)
+
+# Without numba, vectorize_batch spreads at least this many sequences over worker
+# processes, in chunks of PROCESS_CHUNK_SIZE
+PROCESS_POOL_MIN_SEQUENCES = 50000
+PROCESS_CHUNK_SIZE = 4096
+
+if numba is not None:
+    @numba.njit(cache=True, nogil=True)
+    def _vectorize_nb(seq_bytes, lookup, k, counts, out):
+        """
+        Write the k-mer frequencies of seq_bytes to out.
+        
+        K-mers are first counted into the int32 scratch row counts (small enough to stay
+        in L1) with a rolling base-4 index, skipping windows with invalid bases; out is
+        then written exactly once, so it does not need to be zeroed or rescaled in place.
+        """
+        counts[:] = 0
+        mask = counts.shape[0] - 1
+        idx = 0
+        run = 0
+        total = 0
+        for i in range(seq_bytes.shape[0]):
+            code = lookup[seq_bytes[i]]
+            if code > 3:
+                run = 0
+                continue
+            idx = ((idx << 2) | code) & mask
+            run += 1
+            if run >= k:
+                counts[idx] += 1
+                total += 1
+        
+        scale = np.float32(1.0 / total) if total > 0 else np.float32(0.0)
+        for j in range(out.shape[0]):
+            out[j] = counts[j] * scale
+    
+    @numba.njit(cache=True, nogil=True, parallel=True)
+    def _vectorize_batch_nb(data, offsets, lookup, k, out, n_blocks):
+        """
+        Fill row s of out with the k-mer frequencies of data[offsets[s]:offsets[s + 1]].
+        
+        Rows are split into n_blocks contiguous blocks processed in parallel, each
+        reusing one scratch row.
+        """
+        n = out.shape[0]
+        n_blocks = min(n, n_blocks)
+        for b in numba.prange(n_blocks):
+            counts = np.empty(out.shape[1], dtype=np.int32)
+            for s in range(b * n // n_blocks, (b + 1) * n // n_blocks):
+                _vectorize_nb(data[offsets[s]:offsets[s + 1]], lookup, k, counts, out[s])
+    
+    @numba.njit(cache=True, nogil=True)
+    def _kmer_indices_nb(seq_bytes, lookup, k, vocab_size):
+        """Vocabulary index of every valid k-mer, in sequence order."""
+        out = np.empty(max(seq_bytes.shape[0] - k + 1, 0), dtype=np.int64)
+        mask = vocab_size - 1
+        idx = 0
+        run = 0
+        n = 0
+        for i in range(seq_bytes.shape[0]):
+            code = lookup[seq_bytes[i]]
+            if code > 3:
+                run = 0
+                continue
+            idx = ((idx << 2) | code) & mask
+            run += 1
+            if run >= k:
+                out[n] = idx
+                n += 1
+        return out[:n]
+    
+    @numba.njit(cache=True, nogil=True)
+    def _sparse_gemv_i8_nb(matrix_t, indices, values):
+        """int32 dot products of the columns of matrix_t with a sparse int8 vector, row by row."""
+        out = np.zeros(matrix_t.shape[1], dtype=np.int32)
+        for j in range(indices.shape[0]):
+            # Each non-zero reads one contiguous row, which vectorizes to SIMD int8 -> int32
+            row = matrix_t[indices[j]]
+            weight = np.int32(values[j])
+            for n in range(out.shape[0]):
+                out[n] += weight * row[n]
+        return out
+    
+    # Eagerly compiled (and disk-cached) so the first request does not pay for JIT
+    # compilation. Arguments are typed read-only, which also accepts writable arrays
+    # (reference matrices may be memory-mapped, cached query vectors are frozen)
+    def _ro(dtype, ndim):
+        return numba.types.Array(dtype, ndim, 'C', readonly=True)
+    
+    @numba.njit(numba.float32[::1](_ro(numba.float32, 2), _ro(numba.int64, 1), _ro(numba.float32, 1)),
+                cache=True, fastmath=True, nogil=True)
+    def _sparse_gemv_nb(matrix, indices, values):
+        """matrix[:, indices] @ values without materializing the gathered columns."""
+        out = np.empty(matrix.shape[0], dtype=np.float32)
+        for i in range(matrix.shape[0]):
+            acc = np.float32(0.0)
+            for j in range(indices.shape[0]):
+                acc += matrix[i, indices[j]] * values[j]
+            out[i] = acc
+        return out
+
+
+def _as_bytes(sequence):
+    """Sequence as ASCII bytes; bytes input (e.g. from the FASTA parser) is used as is."""
+    return sequence if isinstance(sequence, bytes) else sequence.encode()
 
 
 class KmerVectorizer:
     """Simple k-mer vectorizer for DNA sequences."""
     
-    def __init__(self, k=6):
+    # Read-only byte -> base code table used for all decoding: index it with the
+    # sequence's uint8 bytes to get codes 0-3 (A, T, C, G; N counts as A) or 4 for
+    # bases that invalidate the k-mers containing them
+    BASE_LUT = _LOOKUP
+    
+    def __init__(self, k=6, cache_size=4096):
         self.k = k
+        # K-mers are indexed as base-4 numbers (A=0, T=1, C=2, G=3), first base most significant
+        self.vocab_size = 4 ** k
+        # Sparse vectors of recently seen sequences (a few KiB each, unlike the dense
+        # 4**k form); cached arrays are read-only
+        self._cache = LRUCache(maxsize=cache_size)
+    
+    @cached_property
+    def vocab(self):
+        """Mapping of k-mer string to vector index, built on first use for reverse lookups."""
         bases = ['A', 'T', 'C', 'G']
-        self.vocab = {kmer: idx for idx, kmer in enumerate([''.join(p) for p in itertools.product(bases, repeat=k)])}
-        self.vocab_size = len(self.vocab)
+        return {kmer: idx for idx, kmer in enumerate([''.join(p) for p in itertools.product(bases, repeat=self.k)])}
+    
+    def _cached(self, kind, sequence, compute):
+        """Return compute(sequence) from the cache, computing and storing it on a miss."""
+        key = (kind, sequence_digest(sequence))
+        result = self._cache.get(key)
+        if result is None:
+            result = compute(sequence)
+            for array in (result if isinstance(result, tuple) else (result,)):
+                array.flags.writeable = False
+            self._cache.put(key, result)
+        return result
+    
+    def encode(self, sequence):
+        """Map sequence bytes to base codes 0-3 (A, T, C, G; N counts as A), 4 for invalid bases."""
+        return _LOOKUP[np.frombuffer(_as_bytes(sequence), dtype=np.uint8)]
+    
+    def _valid_starts(self, codes):
+        """Start positions of k-mer windows that contain no invalid base."""
+        invalid_so_far = np.concatenate(([0], np.cumsum(codes > 3)))
+        return np.flatnonzero(invalid_so_far[self.k:] == invalid_so_far[:-self.k])
     
     def tokenize(self, sequence):
         """Convert sequence to k-mers."""
-        sequence = sequence.upper().replace('N', 'A')
-        kmers = []
-        for i in range(len(sequence) - self.k + 1):
-            kmer = sequence[i:i + self.k]
-            if all(base in 'ATCG' for base in kmer):
-                kmers.append(kmer)
-        return kmers
+        codes = self.encode(sequence)
+        # One LUT pass gives the upper-cased, N -> A sequence and the window validity
+        clean = _BASES[codes].tobytes().decode('ascii')
+        return [clean[i:i + self.k] for i in self._valid_starts(codes)]
     
     def vectorize(self, sequence):
-        """Convert sequence to k-mer frequency vector."""
-        kmers = self.tokenize(sequence)
-        kmer_counts = Counter(kmers)
+        """Convert sequence (str or bytes) to k-mer frequency vector (not cached, see vectorize_sparse)."""
+        if numba is not None:
+            vector = np.empty(self.vocab_size, dtype=np.float32)
+            counts = np.empty(self.vocab_size, dtype=np.int32)
+            _vectorize_nb(np.frombuffer(_as_bytes(sequence), dtype=np.uint8), _LOOKUP, self.k, counts, vector)
+            return vector
         
-        vector = np.zeros(self.vocab_size)
-        for kmer, count in kmer_counts.items():
-            if kmer in self.vocab:
-                vector[self.vocab[kmer]] = count
+        # Histogram of the k-mer index stream
+        kmer_idx = self.kmer_indices(sequence)
+        vector = np.bincount(kmer_idx, minlength=self.vocab_size).astype(np.float32)
         
         # Normalize
-        total = len(kmers)
+        total = len(kmer_idx)
         if total > 0:
-            vector = vector / total
+            vector /= total
         
         return vector
+    
+    def vectorize_batch(self, sequences, processes=None):
+        """
+        Convert many sequences to k-mer frequency vectors at once, bypassing the cache.
+        
+        Args:
+            sequences: DNA sequences to vectorize, as str or bytes
+            processes: Worker processes for the NumPy fallback (default: CPU count);
+                the numba kernel is already multi-threaded and never uses them.
+                Pass 1 to always vectorize in the calling process
+        
+        Without numba, batches of at least PROCESS_POOL_MIN_SEQUENCES sequences are
+        split over "spawn" worker processes, which re-import the __main__ module. A
+        script that gets here (e.g. through ReferenceDatabase.create_from_fasta) must
+        therefore guard its top-level code with ``if __name__ == "__main__":``, or
+        pass processes=1; otherwise the workers fail to start and a RuntimeError is raised.
+        
+        Returns:
+            float32 matrix of shape (len(sequences), 4**k) whose rows equal vectorize(),
+            filled in place without per-sequence vectors or a final vstack
+        """
+        if numba is not None:
+            # Rows are counted in parallel from one concatenated byte buffer
+            encoded = [_as_bytes(seq) for seq in sequences]
+            offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+            np.cumsum([len(seq) for seq in encoded], out=offsets[1:])
+            data = np.frombuffer(b''.join(encoded), dtype=np.uint8)
+            matrix = np.empty((len(encoded), self.vocab_size), dtype=np.float32)
+            _vectorize_batch_nb(data, offsets, _LOOKUP, self.k, matrix, numba.get_num_threads() * 4)
+            return matrix
+        
+        matrix = np.zeros((len(sequences), self.vocab_size), dtype=np.float32)
+        processes = processes or os.cpu_count() or 1
+        if processes > 1 and len(sequences) >= PROCESS_POOL_MIN_SEQUENCES:
+            chunks = [sequences[i:i + PROCESS_CHUNK_SIZE] for i in range(0, len(sequences), PROCESS_CHUNK_SIZE)]
+            # Spawned rather than forked: forking a process that already runs threads
+            # (server thread pools, numba's TBB workers) can deadlock
+            try:
+                with ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context("spawn")) as pool:
+                    results = pool.map(_vectorize_chunk_sparse, itertools.repeat(self.k), chunks)
+                    # Workers send back sparse rows, which are much smaller to pickle than dense ones
+                    for start, (indices, values, lengths) in zip(range(0, len(sequences), PROCESS_CHUNK_SIZE), results):
+                        rows = start + np.repeat(np.arange(len(lengths)), lengths)
+                        matrix[rows, indices] = values
+            except BrokenProcessPool as e:
+                raise RuntimeError(
+                    "vectorize_batch worker processes died. Spawned workers re-import the __main__ "
+                    "module, so scripts must guard their entry point with "
+                    "'if __name__ == \"__main__\":' (or pass processes=1)"
+                ) from e
+            return matrix
+        
+        for row, sequence in zip(matrix, sequences):
+            kmer_idx = self.kmer_indices(sequence)
+            row[:] = np.bincount(kmer_idx, minlength=self.vocab_size)
+            if len(kmer_idx) > 0:
+                row /= len(kmer_idx)
+        return matrix
+    
+    def kmer_indices(self, sequence):
+        """Vocabulary indices of the valid k-mers in a sequence."""
+        if numba is not None:
+            seq_bytes = np.frombuffer(_as_bytes(sequence), dtype=np.uint8)
+            return _kmer_indices_nb(seq_bytes, _LOOKUP, self.k, self.vocab_size)
+        
+        codes = self.encode(sequence)
+        starts = self._valid_starts(codes)
+        # Shift in one base per step for every valid window at once (rolling base-4 index)
+        kmer_idx = np.zeros(len(starts), dtype=np.int64)
+        for offset in range(self.k):
+            kmer_idx = (kmer_idx << 2) | codes[starts + offset]
+        return kmer_idx
+    
+    def vectorize_sparse(self, sequence):
+        """
+        Convert sequence to a sparse k-mer frequency vector.
+        
+        Returns (indices, values) for the non-zero entries of vectorize(),
+        without allocating the dense 4**k vector. Results are cached and read-only.
+        """
+        return self._cached("sparse", sequence, self._vectorize_sparse)
+    
+    def _vectorize_sparse(self, sequence):
+        kmer_idx = self.kmer_indices(sequence)
+        indices, counts = np.unique(kmer_idx, return_counts=True)
+        values = counts.astype(np.float32)
+        if len(kmer_idx) > 0:
+            values /= len(kmer_idx)
+        return indices, values
+
+
+def _vectorize_chunk_sparse(k, sequences):
+    """Process-pool worker for vectorize_batch: the chunk's sparse vectors, concatenated."""
+    vectorizer = KmerVectorizer(k=k, cache_size=0)
+    rows = [vectorizer._vectorize_sparse(seq) for seq in sequences]
+    lengths = np.array([len(indices) for indices, _ in rows], dtype=np.int64)
+    return (np.concatenate([indices for indices, _ in rows]).astype(np.int32),
+            np.concatenate([values for _, values in rows]), lengths)
 
 
 def cosine_similarity(vec1, vec2):
@@ -52,3 +307,38 @@ def cosine_similarity(vec1, vec2):
         return 0.0
     
     return np.dot(vec1, vec2) / (norm1 * norm2)
+
+
+def sparse_gemv(matrix, indices, values):
+    """Dot product of every row of matrix with the sparse vector (indices, values)."""
+    if numba is not None and matrix.dtype == np.float32 and matrix.flags.c_contiguous:
+        return _sparse_gemv_nb(matrix, np.ascontiguousarray(indices, dtype=np.int64),
+                               np.ascontiguousarray(values, dtype=np.float32))
+    return matrix[:, indices] @ values
+
+
+def sparse_gemv_i8(matrix_t, indices, values):
+    """
+    Integer dot product of every column of the k-mer-major int8 matrix_t (4**k, N)
+    with the sparse int8 vector (indices, values), returned as int32 of length N.
+    """
+    if numba is not None and matrix_t.flags.c_contiguous:
+        return _sparse_gemv_i8_nb(matrix_t, np.ascontiguousarray(indices, dtype=np.int64),
+                                  np.ascontiguousarray(values, dtype=np.int8))
+    return values.astype(np.int32) @ matrix_t[indices]
+
+
+INT8_SCALE = 127
+
+
+def quantize_int8(vec):
+    """
+    Quantize vector(s) to int8 with a per-row scale using the full [-127, 127] range.
+    
+    Returns (quantized, scales) where quantized / scales approximates vec, so
+    dot products of quantized rows are divided by the product of their scales.
+    """
+    vec = np.asarray(vec, dtype=np.float32)
+    peak = np.abs(vec).max(axis=-1, keepdims=True, initial=0)
+    scales = INT8_SCALE / np.where(peak > 0, peak, 1.0)
+    return np.round(vec * scales).astype(np.int8), scales.squeeze(-1).astype(np.float32)
@@ -1,146 +1,335 @@
 """
 Query engine for ASV sequence comparison.
 """
-from typing import Dict, Any
-import io
-from model.kmer import cosine_similarity
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Any, Iterator, List, Optional
+import os
+import numpy as np
+from model.cache import LRUCache, sequence_digest
+from model.kmer import quantize_int8, sparse_gemv, sparse_gemv_i8
 from search.database import ReferenceDatabase
 
 
+# FASTA queries are scored in chunks of this many sequences, which bounds the
+# (chunk, N) score matrix and lets chunks run on separate threads
+QUERY_CHUNK_SIZE = 256
+
+# Seconds a cached single-query response stays valid
+RESULT_CACHE_TTL = 300
+
+# The ANN index only answers top_k up to its ef and this fraction of the reference rows;
+# larger requests (including top_k=None) are scored exactly. hnswlib cannot reliably
+# return k results once k approaches the number of indexed rows
+ANN_MAX_TOP_K_FRACTION = 0.1
+
+
+def iter_fasta(fasta_content: str) -> Iterator[Dict[str, str]]:
+    """Yield FASTA records from string content one at a time, without splitting it into a list."""
+    # Jump from header to header; anything before the first header is ignored
+    if fasta_content.startswith('>'):
+        pos = 1
+    else:
+        pos = fasta_content.find('\n>')
+        if pos < 0:
+            return
+        pos += 2
+    
+    while pos >= 0:
+        next_header = fasta_content.find('\n>', pos)
+        if next_header < 0:
+            record, pos = fasta_content[pos:], -1
+        else:
+            record, pos = fasta_content[pos:next_header], next_header + 2
+        header, _, body = record.partition('\n')
+        # Whitespace is cleaned up once per record rather than stripping every line
+        yield {'id': header.strip(), 'seq': ''.join(body.split())}
+
+
 def parse_fasta_content(fasta_content: str):
     """Simple FASTA parser for string content without biopython dependency."""
-    sequences = []
-    lines = fasta_content.strip().split('\n')
-    current_id = None
-    current_seq = []
-    
-    for line in lines:
-        line = line.strip()
-        if line.startswith('>'):
-            # Save previous sequence if exists
-            if current_id is not None:
-                sequences.append({
-                    'id': current_id,
-                    'seq': ''.join(current_seq)
-                })
-            # Start new sequence
-            current_id = line[1:]  # Remove '>' character
-            current_seq = []
-        elif line:
-            current_seq.append(line)
-    
-    # Don't forget the last sequence
-    if current_id is not None:
-        sequences.append({
-            'id': current_id,
-            'seq': ''.join(current_seq)
-        })
-    
-    return sequences
+    return list(iter_fasta(fasta_content))
+
+
+def _select_top_k(scores: np.ndarray, threshold: float, top_k: int) -> np.ndarray:
+    """Indices of scores >= threshold, best first and ties in database order, cut to top_k."""
+    # Every reference tied with the cut-off score is pulled in so the selection
+    # among equal scores does not depend on the partition order
+    idx = np.flatnonzero(scores >= threshold)
+    return idx[np.lexsort((idx, -scores[idx]))][:top_k]
+
+
+def top_k_indices(scores: np.ndarray, top_k: Optional[int]) -> np.ndarray:
+    """Return indices of the top-k scores (all of them for None), best first (ties keep database order)."""
+    top_k = len(scores) if top_k is None else min(top_k, len(scores))
+    if top_k <= 0:
+        return np.empty(0, dtype=np.intp)
+    
+    threshold = np.partition(scores, -top_k)[-top_k]
+    return _select_top_k(scores, threshold, top_k)
+
+
+def top_k_indices_batch(scores: np.ndarray, top_k: Optional[int]) -> List[np.ndarray]:
+    """Row-wise top_k_indices for an (M, N) score matrix, partitioning all rows at once."""
+    top_k = scores.shape[1] if top_k is None else min(top_k, scores.shape[1])
+    if top_k <= 0:
+        return [np.empty(0, dtype=np.intp) for _ in range(scores.shape[0])]
+    
+    thresholds = np.partition(scores, -top_k, axis=1)[:, -top_k]
+    return [_select_top_k(row, threshold, top_k) for row, threshold in zip(scores, thresholds)]
 
 
 class SequenceQueryEngine:
     """Engine for querying sequences against reference database."""
     
-    def __init__(self, reference_db: ReferenceDatabase):
+    def __init__(self, reference_db: ReferenceDatabase, cache_size: int = 1024, max_workers: int = None,
+                 cache_ttl: float = RESULT_CACHE_TTL):
         self.reference_db = reference_db
         self.vectorizer = reference_db.vectorizer
+        # Threads used to score FASTA chunks; NumPy/BLAS and the numba kernels release the GIL
+        self.max_workers = max_workers or os.cpu_count() or 1
+        # Single-query responses keyed by (sequence digest, top_k), expiring after cache_ttl seconds
+        self._result_cache = LRUCache(maxsize=cache_size, ttl=cache_ttl)
+    
+    def warmup(self):
+        """Run a dummy query through the single and batch paths so JIT compilation happens up front."""
+        warmup_sequence = "ACGT" * self.vectorizer.k
+        self._score(*self.vectorizer.vectorize_sparse(warmup_sequence))
+        self._match_batch([warmup_sequence], 1)
+    
+    def clear_cache(self):
+        """Forget cached query results, e.g. after the reference database changes."""
+        self._result_cache.clear()
+    
+    def _score(self, indices: np.ndarray, values: np.ndarray) -> np.ndarray:
+        """Cosine similarity of a sparse query vector against every reference."""
+        db = self.reference_db
+        q = values.astype(np.float32)
+        q /= max(np.linalg.norm(q), 1e-12)
+        # Only the columns of k-mers present in the query contribute to the dot product
+        if db.ref_i8_t is not None:
+            q_i8, q_scale = quantize_int8(q)
+            dots = sparse_gemv_i8(db.ref_i8_t, indices, q_i8)
+            # Rounding can push near-identical matches slightly above 1
+            scores = np.minimum(dots / (db.ref_i8_scales * q_scale), 1.0).astype(np.float32)
+        elif db.sparse:
+            # CSC column slicing reads only the stored entries of the query's k-mers
+            scores = db.ref_matrix[:, indices] @ q
+        else:
+            scores = sparse_gemv(db.ref_matrix, indices, q)
+        # Each distinct reference sequence is scored once, then spread over its records
+        return scores[db.vector_index]
+    
+    def _score_batch(self, query_matrix: np.ndarray) -> np.ndarray:
+        """Cosine similarities of M query vectors against every reference, shape (M, N)."""
+        db = self.reference_db
+        Q = query_matrix.astype(np.float32)
+        Q /= np.linalg.norm(Q, axis=1, keepdims=True).clip(min=1e-12)
+        if db.ref_i8_t is not None:
+            # Query vectors are sparse, so each one only reads its own k-mer rows
+            Q_i8, q_scales = quantize_int8(Q)
+            dots = np.empty((len(Q_i8), db.ref_i8_t.shape[1]), dtype=np.int32)
+            for row, q_i8 in zip(dots, Q_i8):
+                indices = np.flatnonzero(q_i8)
+                row[:] = sparse_gemv_i8(db.ref_i8_t, indices, q_i8[indices])
+            scores = np.minimum(dots / np.outer(q_scales, db.ref_i8_scales), 1.0).astype(np.float32)
+        elif db.sparse:
+            scores = np.empty((len(Q), db.ref_matrix.shape[0]), dtype=np.float32)
+            for row, q in zip(scores, Q):
+                indices = np.flatnonzero(q)
+                row[:] = db.ref_matrix[:, indices] @ q[indices]
+        else:
+            scores = Q @ db.ref_matrix.T
+        return scores[:, db.vector_index]
+    
+    def _match_batch(self, sequences: List[str], top_k: int) -> List[List[Dict[str, Any]]]:
+        """Top-k matches for each sequence, scored in a single GEMM (or one ANN index query)."""
+        # Densified per batch from the cached sparse vectors, so the cache never holds 4**k rows
+        query_matrix = np.zeros((len(sequences), self.vectorizer.vocab_size), dtype=np.float32)
+        for row, seq in zip(query_matrix, sequences):
+            indices, values = self.vectorizer.vectorize_sparse(seq)
+            row[indices] = values
+        if self._use_index(top_k):
+            try:
+                labels, similarities = self.reference_db.search_index(query_matrix, top_k)
+                return [self._format_matches(*row) for row in zip(labels, similarities)]
+            except RuntimeError:
+                # hnswlib could not find top_k neighbours; fall through to exact scoring
+                pass
+        
+        scores = self._score_batch(query_matrix)
+        top_indices = top_k_indices_batch(scores, top_k)
+        return [self._format_matches(indices, row_scores[indices]) for row_scores, indices in zip(scores, top_indices)]
+    
+    def _use_index(self, top_k: int) -> bool:
+        """Whether top_k is small enough to answer from the ANN index (see ANN_MAX_TOP_K_FRACTION)."""
+        db = self.reference_db
+        if db.index is None:
+            return False
+        return top_k <= min(db.index.ef, ANN_MAX_TOP_K_FRACTION * db.ref_matrix.shape[0])
+    
+    def _format_matches(self, indices: np.ndarray, scores: np.ndarray) -> List[Dict[str, Any]]:
+        """Build result dicts for the selected references, scores[j] being the score of indices[j]."""
+        db = self.reference_db
+        matches = []
+        for i, score in zip(indices, scores):
+            matches.append({
+                "sample_id": db.sample_ids[i],
+                "sequence_id": db.sequence_ids[i],
+                "similarity_score": float(score),
+                "taxonomy": db.taxonomies[i]
+            })
+        return matches
+    
+    def validate_sequence(self, sequence: str):
+        """Raise ValueError if the sequence is too short to contain a k-mer."""
+        if not sequence or len(sequence) < self.vectorizer.k:
+            raise ValueError(f"Sequence must be at least {self.vectorizer.k} bases long")
+    
+    def resolve_top_k(self, top_k: Optional[int]) -> int:
+        """
+        Number of matches to return for a requested top_k.
+        
+        None means every reference; values above the database size are clamped by the
+        top-k selection. Raises ValueError for negative values.
+        """
+        if top_k is None:
+            return len(self.reference_db)
+        if top_k < 0:
+            raise ValueError("top_k must be a non-negative integer")
+        return top_k
+    
+    def _cache_result(self, cache_key, sequence: str, top_matches: List[Dict[str, Any]]) -> Dict[str, Any]:
+        """Build a single-query response and store it in the result cache."""
+        result = {
+            "query_sequence": sequence,
+            "query_length": len(sequence),
+            "matches_found": len(top_matches),
+            "results": top_matches
+        }
+        self._result_cache.put(cache_key, result)
+        return result
     
-    def query_single_sequence(self, sequence: str, top_k: int = 5) -> Dict[str, Any]:
+    def query_single_sequence(self, sequence: str, top_k: Optional[int] = 5) -> Dict[str, Any]:
         """
         Query a single sequence against the reference database.
         
         Args:
             sequence: DNA sequence to query
-            top_k: Number of top matches to return
+            top_k: Number of top matches to return (None for all)
             
         Returns:
-            Dictionary with query results
+            Dictionary with query results (shared with the result cache, treat as read-only)
         """
-        # Validate sequence
-        if not sequence or len(sequence) < self.vectorizer.k:
-            raise ValueError(f"Sequence must be at least {self.vectorizer.k} bases long")
+        self.validate_sequence(sequence)
+        top_k = self.resolve_top_k(top_k)
+        
+        cache_key = (sequence_digest(sequence), top_k)
+        cached = self._result_cache.get(cache_key)
+        if cached is not None:
+            return cached
         
         # Vectorize query sequence
-        query_vector = self.vectorizer.vectorize(sequence)
-        
-        # Calculate similarities
-        similarities = []
-        for ref_seq in self.reference_db.sequences:
-            similarity = cosine_similarity(query_vector, ref_seq["vector"])
-            similarities.append({
-                "sample_id": ref_seq["sample_id"],
-                "sequence_id": ref_seq["sequence_id"],
-                "similarity_score": float(similarity),
-                "taxonomy": ref_seq["taxonomy"]
-            })
+        indices, values = self.vectorizer.vectorize_sparse(sequence)
         
-        # Sort by similarity and return top-k
-        similarities.sort(key=lambda x: x["similarity_score"], reverse=True)
-        top_matches = similarities[:top_k]
+        top_matches = None
+        if self._use_index(top_k):
+            # Approximate search: the index needs the dense query vector
+            query = np.zeros((1, self.vectorizer.vocab_size), dtype=np.float32)
+            query[0, indices] = values
+            try:
+                labels, similarities = self.reference_db.search_index(query, top_k)
+                top_matches = self._format_matches(labels[0], similarities[0])
+            except RuntimeError:
+                # hnswlib could not find top_k neighbours; score exactly instead
+                pass
+        if top_matches is None:
+            # Calculate similarities and keep the top-k
+            scores = self._score(indices, values)
+            top = top_k_indices(scores, top_k)
+            top_matches = self._format_matches(top, scores[top])
         
-        return {
-            "query_sequence": sequence,
-            "query_length": len(sequence),
-            "matches_found": len(top_matches),
-            "results": top_matches
-        }
+        return self._cache_result(cache_key, sequence, top_matches)
     
-    def query_fasta_sequences(self, fasta_content: str, top_k: int = 5) -> Dict[str, Any]:
+    def query_sequence_batch(self, sequences: List[str], top_ks: List[Optional[int]]) -> List[Dict[str, Any]]:
+        """
+        Query several independent sequences at once, scoring all cache misses in one GEMM.
+        
+        Args:
+            sequences: DNA sequences to query
+            top_ks: Number of top matches to return for each sequence (None for all)
+            
+        Returns:
+            One query_single_sequence-style result per sequence, in order
+        """
+        for sequence in sequences:
+            self.validate_sequence(sequence)
+        top_ks = [self.resolve_top_k(top_k) for top_k in top_ks]
+        
+        cache_keys = [(sequence_digest(sequence), top_k) for sequence, top_k in zip(sequences, top_ks)]
+        results = [self._result_cache.get(key) for key in cache_keys]
+        
+        misses = [i for i, result in enumerate(results) if result is None]
+        if misses:
+            # Score with the largest top_k once and trim per query
+            max_k = max(top_ks[i] for i in misses)
+            batch_matches = self._match_batch([sequences[i] for i in misses], max_k)
+            for i, matches in zip(misses, batch_matches):
+                results[i] = self._cache_result(cache_keys[i], sequences[i], matches[:top_ks[i]])
+        return results
+    
+    def query_fasta_sequences(self, fasta_content: str, top_k: Optional[int] = 5) -> Dict[str, Any]:
         """
         Query multiple sequences from FASTA content against the reference database.
         
         Args:
             fasta_content: FASTA format string content
-            top_k: Number of top matches to return per sequence
+            top_k: Number of top matches to return per sequence (None for all)
             
         Returns:
             Dictionary with query results for all sequences
         """
-        # Parse FASTA sequences
-        sequences = parse_fasta_content(fasta_content)
+        top_k = self.resolve_top_k(top_k)
+        # Stream FASTA records, keeping only (id, length, row) per record.
+        # Identical sequences (common for ASVs) are vectorized and scored once
+        unique_rows = {}
+        records = []
+        for seq_data in iter_fasta(fasta_content):
+            row = unique_rows.setdefault(seq_data["seq"], len(unique_rows))
+            records.append((seq_data["id"], len(seq_data["seq"]), row))
         
-        if not sequences:
+        if not records:
             raise ValueError("No valid sequences found in FASTA content")
         
-        # Process each sequence
+        # Score unique sequences chunk by chunk, one GEMM per chunk, in parallel
+        unique_seqs = list(unique_rows)
+        chunks = [unique_seqs[i:i + QUERY_CHUNK_SIZE] for i in range(0, len(unique_seqs), QUERY_CHUNK_SIZE)]
+        if len(chunks) == 1 or self.max_workers == 1:
+            chunk_matches = [self._match_batch(chunk, top_k) for chunk in chunks]
+        else:
+            with ThreadPoolExecutor(max_workers=min(self.max_workers, len(chunks))) as pool:
+                chunk_matches = list(pool.map(lambda chunk: self._match_batch(chunk, top_k), chunks))
+        unique_matches = [matches for chunk in chunk_matches for matches in chunk]
+        
         results = []
-        for seq_data in sequences:
-            query_vector = self.vectorizer.vectorize(seq_data["seq"])
-            
-            # Calculate similarities
-            similarities = []
-            for ref_seq in self.reference_db.sequences:
-                similarity = cosine_similarity(query_vector, ref_seq["vector"])
-                similarities.append({
-                    "sample_id": ref_seq["sample_id"],
-                    "sequence_id": ref_seq["sequence_id"],
-                    "similarity_score": float(similarity),
-                    "taxonomy": ref_seq["taxonomy"]
-                })
-            
-            # Sort and get top matches
-            similarities.sort(key=lambda x: x["similarity_score"], reverse=True)
-            top_matches = similarities[:top_k]
-            
+        for seq_id, seq_length, row in records:
             results.append({
-                "query_sequence_id": seq_data["id"],
-                "query_length": len(seq_data["seq"]),
-                "matches": top_matches
+                "query_sequence_id": seq_id,
+                "query_length": seq_length,
+                "matches": unique_matches[row]
             })
         
         return {
-            "total_sequences": len(sequences),
+            "total_sequences": len(records),
             "results": results
         }
     
-    def query_fasta_file(self, fasta_file: str, top_k: int = 5) -> Dict[str, Any]:
+    def query_fasta_file(self, fasta_file: str, top_k: Optional[int] = 5) -> Dict[str, Any]:
         """
         Query sequences from a FASTA file against the reference database.
         
         Args:
             fasta_file: Path to FASTA file
-            top_k: Number of top matches to return per sequence
+            top_k: Number of top matches to return per sequence (None for all)
             
         Returns:
             Dictionary with query results for all sequences
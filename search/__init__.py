@@ -1,4 +1,4 @@
 """Search package for reference database operations."""
-from .database import ReferenceDatabase, parse_fasta
+from .database import ReferenceDatabase, SequenceRecord, parse_fasta
 
-__all__ = ['ReferenceDatabase', 'parse_fasta']
+__all__ = ['ReferenceDatabase', 'SequenceRecord', 'parse_fasta']
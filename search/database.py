@@ -1,50 +1,308 @@
 """
 Reference database operations for ASV sequence comparison.
 """
+import json
+import mmap
 import pickle
 import os
-from typing import Dict, Any
-from model.kmer import KmerVectorizer
+import struct
+import tempfile
+import zipfile
+from dataclasses import dataclass
+from typing import Dict, Any, Iterator, List, Optional, Tuple
+import numpy as np
+from model.kmer import KmerVectorizer, quantize_int8
+
+try:
+    import hnswlib
+except ImportError:
+    hnswlib = None
+
+try:
+    import scipy.sparse as scipy_sparse
+except ImportError:
+    scipy_sparse = None
+
+
+# Files at least this large get kernel read-ahead hints before being scanned
+_READAHEAD_MIN_BYTES = 1 << 20
+
+
+def _parse_fasta_records(fasta_file: str) -> Iterator[Tuple[str, bytes, int, int]]:
+    """
+    Yield (id, sequence bytes, offset, length) tuples from a FASTA file, one record at a time.
+    
+    offset and length locate the record's sequence lines in the file (see _read_fasta_sequence).
+    """
+    with open(fasta_file, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size == 0:
+            return
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    
+    with data:
+        if size >= _READAHEAD_MIN_BYTES and hasattr(mmap, 'MADV_SEQUENTIAL'):
+            # Larger read-ahead window, and start paging the file in right away (cold cache)
+            data.madvise(mmap.MADV_SEQUENTIAL)
+            data.madvise(mmap.MADV_WILLNEED)
+        
+        # Jump from header to header; anything before the first header is ignored
+        if data[:1] == b'>':
+            pos = 1
+        else:
+            pos = data.find(b'\n>')
+            if pos < 0:
+                return
+            pos += 2
+        
+        while pos >= 0:
+            next_header = data.find(b'\n>', pos)
+            # Only the current record is copied out of the mapping
+            start = pos
+            if next_header < 0:
+                record, pos = data[pos:], -1
+            else:
+                record, pos = data[pos:next_header], next_header + 2
+            header, newline, body = record.partition(b'\n')
+            offset = start + len(header) + len(newline)
+            # Drop line breaks and padding from the whole record at once; the sequence
+            # stays bytes, so the vectorizer reads it without a str round trip
+            yield header.strip().decode(), body.translate(None, b'\r\n\t '), offset, len(body)
 
 
 def parse_fasta(fasta_file: str):
     """Simple FASTA parser without biopython dependency."""
-    sequences = []
-    with open(fasta_file, 'r') as f:
-        current_id = None
-        current_seq = []
-        
-        for line in f:
-            line = line.strip()
-            if line.startswith('>'):
-                # Save previous sequence if exists
-                if current_id is not None:
-                    sequences.append({
-                        'id': current_id,
-                        'seq': ''.join(current_seq)
-                    })
-                # Start new sequence
-                current_id = line[1:]  # Remove '>' character
-                current_seq = []
-            elif line:
-                current_seq.append(line)
-        
-        # Don't forget the last sequence
-        if current_id is not None:
-            sequences.append({
-                'id': current_id,
-                'seq': ''.join(current_seq)
-            })
-    
-    return sequences
+    return [{'id': seq_id, 'seq': seq.decode()} for seq_id, seq, _, _ in _parse_fasta_records(fasta_file)]
+
+
+def _read_fasta_sequence(fasta_file: str, offset: int, length: int) -> str:
+    """Re-read one sequence located by _parse_fasta_records from its FASTA file."""
+    with open(fasta_file, 'rb') as f:
+        f.seek(offset)
+        return f.read(length).translate(None, b'\r\n\t ').decode()
+
+
+def _issparse(matrix) -> bool:
+    return scipy_sparse is not None and scipy_sparse.issparse(matrix)
+
+
+def _unit_rows(matrix):
+    """Return the matrix as float32 with every row scaled to unit L2 norm (zero rows stay zero)."""
+    if _issparse(matrix):
+        matrix = scipy_sparse.csr_matrix(matrix, dtype=np.float32)
+        norms = np.sqrt(np.asarray(matrix.multiply(matrix).sum(axis=1)).ravel())
+        return scipy_sparse.diags((1 / np.where(norms > 0, norms, 1)).astype(np.float32)) @ matrix
+    matrix = np.asarray(matrix, dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    return matrix / np.where(norms > 0, norms, 1)
+
+
+def _mmap_npz_member(filepath: str, name: str):
+    """
+    Memory-map an array stored uncompressed inside a .npz archive.
+    
+    Returns a read-only np.memmap backed by the archive itself, or None when the
+    member is compressed, or its data is misaligned for the dtype (archives written
+    before _savez_aligned), and has to be read normally.
+    """
+    with zipfile.ZipFile(filepath) as archive:
+        info = archive.getinfo(f"{name}.npy")
+    if info.compress_type != zipfile.ZIP_STORED:
+        return None
+    
+    with open(filepath, "rb") as f:
+        # Skip the zip local file header (30 bytes + file name + extra field)
+        f.seek(info.header_offset)
+        local_header = f.read(30)
+        name_length, extra_length = struct.unpack("<HH", local_header[26:30])
+        f.seek(info.header_offset + 30 + name_length + extra_length)
+        
+        # Then the .npy header, after which the raw array data starts
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+            shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+        else:
+            shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+        offset = f.tell()
+    
+    # Misaligned arrays fall off NumPy's fast (BLAS/SIMD) paths; a private copy is aligned
+    if offset % dtype.alignment:
+        return None
+    return np.memmap(filepath, dtype=dtype, mode="r", offset=offset, shape=shape,
+                     order="F" if fortran_order else "C")
+
+
+# Array data in uncompressed archives starts at a multiple of this many bytes
+_NPZ_ALIGN = 64
+# Extra field id used for the padding (the one Android's zipalign uses)
+_ZIP_PADDING_ID = 0xD935
+
+
+def _savez_aligned(file, arrays: Dict[str, np.ndarray]):
+    """
+    Like np.savez, but pads each member's zip local header so its array data starts
+    at a _NPZ_ALIGN-byte boundary of the file, where _mmap_npz_member maps it.
+    """
+    with zipfile.ZipFile(file, "w", zipfile.ZIP_STORED, allowZip64=True) as archive:
+        for name, array in arrays.items():
+            info = zipfile.ZipInfo(f"{name}.npy", date_time=(1980, 1, 1, 0, 0, 0))
+            # Local header: 30 bytes + name + our extra field (4-byte header + padding)
+            # + the 20-byte zip64 field written for force_zip64; .npy headers are
+            # already padded to a multiple of 64 bytes
+            header_end = archive.fp.tell() + 30 + len(info.filename) + 4 + 20
+            padding = -header_end % _NPZ_ALIGN
+            info.extra = struct.pack("<HH", _ZIP_PADDING_ID, padding) + bytes(padding)
+            with archive.open(info, "w", force_zip64=True) as f:
+                np.lib.format.write_array(f, np.asanyarray(array), allow_pickle=False)
+
+
+# Pickle files written by save() start with this marker, followed by a protocol 5
+# pickle stream and its out-of-band buffers, each prefixed with its byte length
+_PICKLE_MAGIC = b"ASVDB\x00P5"
+_LENGTH = struct.Struct("<Q")
+
+
+def _dump_pickle(obj, f):
+    """Pickle obj to f with protocol 5, writing array data straight from its buffers."""
+    buffers = []
+    stream = pickle.dumps(obj, protocol=5, buffer_callback=buffers.append)
+    f.write(_PICKLE_MAGIC)
+    f.write(_LENGTH.pack(len(stream)))
+    f.write(stream)
+    f.write(_LENGTH.pack(len(buffers)))
+    for buffer in buffers:
+        raw = buffer.raw()
+        f.write(_LENGTH.pack(raw.nbytes))
+        f.write(raw)
+
+
+def _load_pickle(f):
+    """Load a pickle written by _dump_pickle, or a plain pickle from older versions."""
+    if f.read(len(_PICKLE_MAGIC)) != _PICKLE_MAGIC:
+        f.seek(0)
+        return pickle.load(f)
+    
+    def read_block():
+        (length,) = _LENGTH.unpack(f.read(_LENGTH.size))
+        # Read into an uninitialized writable buffer so unpickled arrays stay writable
+        block = np.empty(length, dtype=np.uint8)
+        f.readinto(block)
+        return block
+    
+    stream = read_block()
+    (count,) = _LENGTH.unpack(f.read(_LENGTH.size))
+    return pickle.loads(stream, buffers=[read_block() for _ in range(count)])
+
+
+def _object_array(values) -> np.ndarray:
+    """1-D object array of the given values (np.array would try to nest sequences)."""
+    array = np.empty(len(values), dtype=object)
+    array[:] = values
+    return array
+
+
+@dataclass(slots=True)
+class SequenceRecord:
+    """One reference record as returned by ReferenceDatabase.sequences (no per-instance dict)."""
+    sample_id: str
+    sequence_id: str
+    taxonomy: Optional[str]
+    vector: np.ndarray
+    sequence: Optional[str] = None
+
+
+# Sparse databases are vectorized this many distinct sequences at a time, which
+# bounds the dense intermediate matrix
+SPARSE_BLOCK_ROWS = 4096
 
 
 class ReferenceDatabase:
     """Reference database for ASV sequences."""
     
-    def __init__(self, k=6):
+    def __init__(self, k=6, quantize=False, sparse=False, keep_sequences=False):
+        """
+        Args:
+            k: K-mer size used to vectorize sequences
+            quantize: Also keep an int8 copy of the reference matrix (a quarter of
+                the float32 size) and score queries against it (approximate
+                similarity scores)
+            sparse: Store ref_matrix as a scipy.sparse CSC matrix. Short sequences
+                only contain a few percent of the 4**k k-mers, so this is much
+                smaller than the dense matrix, and a query only reads the columns
+                of the k-mers it contains (requires scipy)
+            keep_sequences: Keep every record's sequence string in raw_sequences.
+                Searching only needs the vectors, so by default built databases
+                store None instead; sequences of a database built from a FASTA
+                file can still be read back from it with get_sequence()
+        """
+        if sparse and scipy_sparse is None:
+            raise ImportError("scipy is required for sparse reference storage (pip install scipy)")
+        if sparse and quantize:
+            raise ValueError("quantize and sparse storage cannot be combined")
+        
         self.vectorizer = KmerVectorizer(k=k)
-        self.sequences = []
+        self.quantize = quantize
+        self.sparse = sparse
+        self.keep_sequences = keep_sequences
+        
+        # Records are stored as parallel arrays; identical sequences share one row of
+        # ref_matrix, and vector_index maps every record to its row
+        self.sample_ids = np.empty(0, dtype=object)
+        self.sequence_ids = np.empty(0, dtype=object)
+        self.raw_sequences = np.empty(0, dtype=object)
+        self.taxonomies = np.empty(0, dtype=object)
+        # Source FASTA and per-record (offset, length) of the sequence lines in it,
+        # so get_sequence() can re-read sequences that were not kept
+        self.sequence_file = None
+        self.sequence_offsets = None
+        self.ref_matrix = np.zeros((0, self.vectorizer.vocab_size), dtype=np.float32)
+        self.vector_index = np.empty(0, dtype=np.intp)
+        # (ref_i8_t, ref_i8_scales) once built on first use, see ref_i8_t
+        self._ref_i8 = None
+        # Optional approximate nearest-neighbour index over ref_matrix (see build_index)
+        self.index = None
+        self._index_records = None
+        # get_info() result, cleared whenever the records change
+        self._info_cache = None
+    
+    def __len__(self):
+        return len(self.sequence_ids)
+    
+    def __getitem__(self, i: int) -> SequenceRecord:
+        return self.record(i)
+    
+    def record(self, i: int) -> SequenceRecord:
+        """Record i as a SequenceRecord, built from the parallel arrays (O(1); db[i] does the same)."""
+        return SequenceRecord(
+            sample_id=self.sample_ids[i],
+            sequence_id=self.sequence_ids[i],
+            taxonomy=self.taxonomies[i],
+            vector=self._vector(self.vector_index[i]),
+            sequence=self.raw_sequences[i]
+        )
+    
+    @property
+    def sequences(self) -> List[SequenceRecord]:
+        """
+        All records as a list of SequenceRecord, rebuilt from the parallel arrays on
+        every access (O(N)); use record(i) or db[i] for single records.
+        """
+        return [self.record(i) for i in range(len(self))]
+    
+    def get_sequence(self, i: int):
+        """
+        Sequence of record i.
+        
+        Sequences that were not kept in memory are re-read from the FASTA file the
+        database was built from.
+        
+        Returns:
+            The sequence string, or None if it is neither kept nor locatable
+        """
+        if self.raw_sequences[i] is not None or self.sequence_offsets is None:
+            return self.raw_sequences[i]
+        offset, length = self.sequence_offsets[i]
+        return _read_fasta_sequence(self.sequence_file, int(offset), int(length))
     
     def create_from_fasta(self, fasta_file: str, taxonomy_mapping: Dict[str, str] = None):
         """
@@ -54,21 +312,21 @@ class ReferenceDatabase:
             fasta_file: Path to FASTA file
             taxonomy_mapping: Optional mapping of sequence_id to taxonomy
         """
-        self.sequences = []
+        sequence_ids, sequences, taxonomies, offsets = [], [], [], []
+        # Decided once rather than per record
+        get_taxonomy = taxonomy_mapping.get if taxonomy_mapping else (lambda seq_id: None)
         
-        for record in parse_fasta(fasta_file):
-            sequence_data = {
-                "sample_id": "reference",  # Default sample ID
-                "sequence_id": record['id'],
-                "sequence": record['seq'],
-                "taxonomy": taxonomy_mapping.get(record['id']) if taxonomy_mapping else None
-            }
-            
-            # Vectorize sequence
-            vector = self.vectorizer.vectorize(sequence_data["sequence"])
-            sequence_data["vector"] = vector
-            
-            self.sequences.append(sequence_data)
+        # Records are streamed instead of parsed into a list of dicts first
+        for seq_id, seq, offset, length in _parse_fasta_records(fasta_file):
+            sequence_ids.append(seq_id)
+            sequences.append(seq)
+            taxonomies.append(get_taxonomy(seq_id))
+            offsets.append((offset, length))
+        
+        sample_ids = ["reference"] * len(sequence_ids)  # Default sample ID
+        self._set_unique_records(sample_ids, sequence_ids, sequences, taxonomies)
+        self.sequence_file = os.path.abspath(fasta_file)
+        self.sequence_offsets = np.array(offsets, dtype=np.int64).reshape(-1, 2)
     
     def create_sample_database(self):
         """Create a sample reference database for testing."""
@@ -99,37 +357,366 @@ class ReferenceDatabase:
             }
         ]
         
-        self.sequences = []
-        for seq_data in sample_sequences:
-            vector = self.vectorizer.vectorize(seq_data["sequence"])
-            seq_data["vector"] = vector
-            self.sequences.append(seq_data)
+        self._set_unique_records(
+            [seq_data["sample_id"] for seq_data in sample_sequences],
+            [seq_data["sequence_id"] for seq_data in sample_sequences],
+            [seq_data["sequence"] for seq_data in sample_sequences],
+            [seq_data["taxonomy"] for seq_data in sample_sequences]
+        )
     
-    def save(self, filepath: str):
-        """Save database to pickle file."""
-        with open(filepath, "wb") as f:
-            pickle.dump(self.sequences, f)
+    def _set_unique_records(self, sample_ids, sequence_ids, sequences, taxonomies):
+        """Store records, vectorizing each distinct sequence once (ASVs repeat across samples)."""
+        rows = {}
+        vector_index = [rows.setdefault(seq, len(rows)) for seq in sequences]
+        unique = list(rows)
+        if self.sparse and unique:
+            vectors = scipy_sparse.vstack([
+                scipy_sparse.csr_matrix(self.vectorizer.vectorize_batch(unique[i:i + SPARSE_BLOCK_ROWS]))
+                for i in range(0, len(unique), SPARSE_BLOCK_ROWS)
+            ])
+        else:
+            vectors = self.vectorizer.vectorize_batch(unique)
+        if not self.keep_sequences:
+            sequences = [None] * len(sequences)
+        elif unique and isinstance(unique[0], bytes):
+            # Parsed sequences were vectorized as bytes; decode each distinct one once for storage
+            text = [seq.decode() for seq in unique]
+            sequences = [text[row] for row in vector_index]
+        self._set_records(sample_ids, sequence_ids, sequences, taxonomies, vectors, vector_index)
     
-    def load(self, filepath: str):
-        """Load database from pickle file."""
+    def _set_records(self, sample_ids, sequence_ids, sequences, taxonomies, vectors, vector_index=None):
+        """
+        Store records as parallel arrays and their k-mer vectors as ref_matrix.
+        
+        Rows are normalized once here so queries skip the reference norms.
+        
+        Args:
+            vectors: One k-mer vector per record, or per distinct sequence with vector_index
+            vector_index: Row of vectors for each record (defaults to one row per record)
+        """
+        self.sample_ids = _object_array(sample_ids)
+        self.sequence_ids = _object_array(sequence_ids)
+        self.raw_sequences = _object_array(sequences)
+        self.taxonomies = _object_array(taxonomies)
+        self.sequence_file = None
+        self.sequence_offsets = None
+        
+        if vectors.shape[0]:
+            self.ref_matrix = self._as_storage(_unit_rows(vectors))
+        else:
+            self.ref_matrix = self._as_storage(np.zeros((0, self.vectorizer.vocab_size), dtype=np.float32))
+        self._set_vector_index(vector_index)
+        self._data_updated()
+    
+    def _as_storage(self, matrix):
+        """Convert a reference matrix to the configured storage: CSC when sparse, else C-contiguous float32."""
+        if self.sparse:
+            return scipy_sparse.csc_matrix(matrix, dtype=np.float32)
+        if _issparse(matrix):
+            matrix = matrix.toarray()
+        # Scoring streams over ref_matrix rows and expects one C-contiguous float32 block
+        return np.ascontiguousarray(matrix, dtype=np.float32)
+    
+    def _vector(self, row: int) -> np.ndarray:
+        """Dense k-mer vector stored in row of ref_matrix."""
+        if self.sparse:
+            return self.ref_matrix[row].toarray()[0]
+        return self.ref_matrix[row]
+    
+    def _set_vector_index(self, vector_index):
+        """Set the record -> ref_matrix row mapping, one row per record when vector_index is None."""
+        if vector_index is None:
+            self.vector_index = np.arange(len(self), dtype=np.intp)
+        else:
+            self.vector_index = np.asarray(vector_index, dtype=np.intp)
+    
+    @property
+    def ref_i8_t(self):
+        """
+        Quantized copy of ref_matrix, stored k-mer-major (4**k, rows) so a sparse query
+        reads one contiguous row per k-mer it contains (None unless quantize is set).
+        
+        Built on first use, normally the first query: quantizing reads the whole of
+        ref_matrix, which would otherwise defeat memory-mapped loading.
+        """
+        if self.quantize and self._ref_i8 is None:
+            ref_i8, scales = quantize_int8(self.ref_matrix)
+            self._ref_i8 = (np.ascontiguousarray(ref_i8.T), scales)
+        return self._ref_i8[0] if self._ref_i8 is not None else None
+    
+    @property
+    def ref_i8_scales(self):
+        """Per-row scales of ref_i8_t (None unless quantize is set)."""
+        return self._ref_i8[1] if self.ref_i8_t is not None else None
+    
+    def _data_updated(self):
+        """Drop data derived from the records and ref_matrix: the int8 copy, any stale ANN index and info."""
+        self._ref_i8 = None
+        self.index = None
+        self._index_records = None
+        self._info_cache = None
+    
+    def build_index(self, M: int = 16, ef_construction: int = 200, ef: int = 50):
+        """
+        Build an HNSW index (cosine space) over the rows of ref_matrix for approximate top-k search.
+        
+        Args:
+            M: Graph connectivity; higher improves recall at the cost of memory
+            ef_construction: Candidate list size while building the graph
+            ef: Candidate list size at query time (recall/speed trade-off, see set_ef)
+        """
+        if hnswlib is None:
+            raise ImportError("hnswlib is required to build an ANN index (pip install hnswlib)")
+        
+        n_vectors = self.ref_matrix.shape[0]
+        index = hnswlib.Index(space='cosine', dim=self.ref_matrix.shape[1])
+        index.init_index(max_elements=max(n_vectors, 1), M=M, ef_construction=ef_construction)
+        if self.sparse:
+            # hnswlib only takes dense vectors
+            for start in range(0, n_vectors, SPARSE_BLOCK_ROWS):
+                stop = min(start + SPARSE_BLOCK_ROWS, n_vectors)
+                index.add_items(self.ref_matrix[start:stop].toarray(), np.arange(start, stop))
+        elif n_vectors > 0:
+            index.add_items(self.ref_matrix, np.arange(n_vectors))
+        index.set_ef(ef)
+        
+        # Records of each row in database order: order[starts[r]:starts[r + 1]]
+        order = np.argsort(self.vector_index, kind="stable")
+        starts = np.searchsorted(self.vector_index[order], np.arange(n_vectors + 1))
+        self._index_records = (order, starts)
+        self.index = index
+        self._info_cache = None
+    
+    def set_ef(self, ef: int):
+        """Set the query-time candidate list size of the ANN index."""
+        self.index.set_ef(ef)
+        self._info_cache = None
+    
+    def search_index(self, query_matrix: np.ndarray, top_k: int):
+        """
+        Approximate top-k search of M query vectors with the ANN index.
+        
+        Returns:
+            (records, similarities), both of shape (M, top_k) with best matches first
+        """
+        top_k = min(top_k, len(self))
+        if top_k <= 0:
+            empty = np.empty((len(query_matrix), 0))
+            return empty.astype(np.intp), empty.astype(np.float32)
+        
+        # Every row belongs to at least one record, so top_k rows yield at least top_k records
+        labels, distances = self.index.knn_query(query_matrix, k=min(top_k, self.ref_matrix.shape[0]))
+        order, starts = self._index_records
+        records = np.empty((len(labels), top_k), dtype=np.intp)
+        similarities = np.empty((len(labels), top_k), dtype=np.float32)
+        for i, (row_labels, row_distances) in enumerate(zip(labels, distances)):
+            row_records = np.concatenate([order[starts[r]:starts[r + 1]] for r in row_labels])
+            records[i] = row_records[:top_k]
+            similarities[i] = np.repeat(1.0 - row_distances, np.diff(starts)[row_labels])[:top_k]
+        return records, similarities
+    
+    def save(self, filepath: str, compress: bool = True):
+        """
+        Save database to file.
+        
+        Paths ending in .npz are written as a NumPy archive holding ref_matrix (or
+        its CSC arrays for sparse databases) plus the record metadata as JSON;
+        anything else is pickled.
+        Sequences are only written when some record kept its sequence; the FASTA
+        offsets used by get_sequence() are saved either way.
+        
+        The file is written under a temporary name in the same directory and renamed
+        into place, so concurrent readers (e.g. workers loading it at startup) see
+        either the old file or the complete new one, and existing memory maps of the
+        old file stay valid.
+        
+        Args:
+            filepath: Destination path
+            compress: Compress the .npz archive; uncompressed archives can be
+                memory-mapped by load(..., mmap=True)
+        """
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(filepath)),
+                                        prefix=f".{os.path.basename(filepath)}.", suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                if filepath.endswith(".npz"):
+                    self._save_npz(f, compress)
+                else:
+                    self._save_pickle(f)
+            # mkstemp creates owner-only files; databases are shared with other users' workers
+            os.chmod(tmp_path, 0o644)
+            os.replace(tmp_path, filepath)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+    
+    def _save_pickle(self, f):
+        data = {
+            "k": self.vectorizer.k,
+            "sample_ids": self.sample_ids,
+            "sequence_ids": self.sequence_ids,
+            "taxonomies": self.taxonomies,
+            "ref_matrix": self.ref_matrix if self.sparse else np.ascontiguousarray(self.ref_matrix),
+            "vector_index": self.vector_index,
+            "sequence_file": self.sequence_file,
+            "sequence_offsets": self.sequence_offsets
+        }
+        if self._has_sequences():
+            data["raw_sequences"] = self.raw_sequences
+        _dump_pickle(data, f)
+    
+    def _has_sequences(self) -> bool:
+        """Whether any record keeps its sequence; saved files omit raw_sequences otherwise."""
+        return any(seq is not None for seq in self.raw_sequences)
+    
+    def _save_npz(self, f, compress: bool):
+        metadata = {
+            "k": self.vectorizer.k,
+            "sample_ids": self.sample_ids.tolist(),
+            "sequence_ids": self.sequence_ids.tolist(),
+            "taxonomies": self.taxonomies.tolist(),
+            "sequence_file": self.sequence_file
+        }
+        if self._has_sequences():
+            metadata["raw_sequences"] = self.raw_sequences.tolist()
+        # Metadata is stored as UTF-8 bytes; a NumPy string scalar would be UTF-32 (4 bytes per character)
+        metadata = np.frombuffer(json.dumps(metadata).encode(), dtype=np.uint8)
+        if self.sparse:
+            matrix = {
+                "ref_data": self.ref_matrix.data,
+                "ref_indices": self.ref_matrix.indices,
+                "ref_indptr": self.ref_matrix.indptr,
+                "ref_shape": np.array(self.ref_matrix.shape)
+            }
+        else:
+            matrix = {"ref_matrix": self.ref_matrix}
+        if self.sequence_offsets is not None:
+            matrix["sequence_offsets"] = self.sequence_offsets
+        arrays = dict(matrix, vector_index=self.vector_index, metadata=metadata)
+        if compress:
+            np.savez_compressed(f, **arrays)
+        else:
+            # Memory-mapped on load, so every array must start aligned
+            _savez_aligned(f, arrays)
+    
+    def load(self, filepath: str, mmap: bool = False):
+        """
+        Load database from a .npz archive or pickle file (see save).
+        
+        Args:
+            filepath: Path to the database file
+            mmap: Memory-map ref_matrix from an uncompressed .npz archive instead of
+                reading it into memory. Loading then only reads the metadata, the OS
+                pages vectors in as queries touch them, and processes loading the same
+                file share one copy through the page cache. The matrix is read-only;
+                call materialize() to read it fully into private memory. With quantize,
+                the int8 copy is built from the whole matrix at the first query, which
+                pages all of it in
+        """
         if not os.path.exists(filepath):
             return False
         
+        if filepath.endswith(".npz"):
+            self._load_npz(filepath, mmap)
+            return True
+        
         with open(filepath, "rb") as f:
-            self.sequences = pickle.load(f)
+            data = _load_pickle(f)
+        
+        # Older databases were saved as a plain list of sequence dicts
+        if isinstance(data, list):
+            self._set_records(
+                [seq["sample_id"] for seq in data],
+                [seq["sequence_id"] for seq in data],
+                [seq.get("sequence") for seq in data],
+                [seq.get("taxonomy") for seq in data],
+                np.array([seq["vector"] for seq in data], dtype=np.float32)
+            )
+        else:
+            self._check_k(data.get("k", self.vectorizer.k))
+            self.sample_ids = data["sample_ids"]
+            self.sequence_ids = data["sequence_ids"]
+            self.raw_sequences = data.get("raw_sequences", np.full(len(self.sequence_ids), None, dtype=object))
+            self.taxonomies = data["taxonomies"]
+            self.sequence_file = data.get("sequence_file")
+            self.sequence_offsets = data.get("sequence_offsets")
+            self.ref_matrix = self._as_storage(data["ref_matrix"])
+            # Databases saved before deduplication have one row per record
+            self._set_vector_index(data.get("vector_index"))
+            self._data_updated()
         return True
     
+    def materialize(self):
+        """
+        Read a memory-mapped ref_matrix fully into (writable) process memory.
+        
+        Useful before scoring that touches every vector anyway, so page faults do not
+        land on the first queries (a matrix already in memory is simply copied).
+        """
+        if self.sparse:
+            self.ref_matrix = self.ref_matrix.copy()
+        else:
+            self.ref_matrix = np.array(self.ref_matrix)
+    
+    def _check_k(self, k: int):
+        """Raise ValueError if a stored database was built with a different k-mer size."""
+        if k != self.vectorizer.k:
+            raise ValueError(f"Database was built with k={k}, expected k={self.vectorizer.k}")
+    
+    def _load_npz(self, filepath: str, mmap: bool):
+        with np.load(filepath) as archive:
+            metadata = archive["metadata"]
+            # Archives written before metadata was stored as bytes hold a string scalar
+            metadata = json.loads(metadata.item() if metadata.dtype.kind == "U" else metadata.tobytes())
+            
+            def member(name):
+                array = _mmap_npz_member(filepath, name) if mmap else None
+                return archive[name] if array is None else array
+            
+            if "ref_indptr" in archive.files:
+                if scipy_sparse is None:
+                    raise ImportError("scipy is required to load a sparse database (pip install scipy)")
+                ref_matrix = scipy_sparse.csc_matrix(
+                    (member("ref_data"), member("ref_indices"), member("ref_indptr")),
+                    shape=tuple(archive["ref_shape"])
+                )
+            else:
+                ref_matrix = member("ref_matrix")
+            # Archives saved before deduplication have one row per record
+            vector_index = archive["vector_index"] if "vector_index" in archive.files else None
+            sequence_offsets = archive["sequence_offsets"] if "sequence_offsets" in archive.files else None
+        
+        self._check_k(metadata["k"])
+        
+        self.sample_ids = _object_array(metadata["sample_ids"])
+        self.sequence_ids = _object_array(metadata["sequence_ids"])
+        self.raw_sequences = _object_array(metadata.get("raw_sequences", [None] * len(self.sequence_ids)))
+        self.taxonomies = _object_array(metadata["taxonomies"])
+        self.sequence_file = metadata.get("sequence_file")
+        self.sequence_offsets = sequence_offsets
+        self.ref_matrix = self._as_storage(ref_matrix)
+        self._set_vector_index(vector_index)
+        self._data_updated()
+    
     def get_info(self) -> Dict[str, Any]:
-        """Get database information."""
-        if not self.sequences:
+        """Get database information (cached until the records change, treat as read-only)."""
+        if self._info_cache is None:
+            self._info_cache = self._compute_info()
+        return self._info_cache
+    
+    def _compute_info(self) -> Dict[str, Any]:
+        if len(self) == 0:
             return {"total_sequences": 0}
         
-        unique_samples = set(seq["sample_id"] for seq in self.sequences)
+        unique_samples = np.unique(self.sample_ids)
         
         return {
-            "total_sequences": len(self.sequences),
+            "total_sequences": len(self),
             "unique_samples": len(unique_samples),
-            "sample_ids": list(unique_samples),
-            "vector_dimension": len(self.sequences[0]["vector"]) if self.sequences else 0,
-            "k_mer_size": self.vectorizer.k
+            "sample_ids": unique_samples.tolist(),
+            "vector_dimension": self.ref_matrix.shape[1],
+            "k_mer_size": self.vectorizer.k,
+            # Queries go through the HNSW index when one is built, so scores are approximate
+            "search_mode": "approximate" if self.index is not None else "exact",
+            **({"ann_ef": self.index.ef} if self.index is not None else {})
         }
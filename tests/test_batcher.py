@@ -0,0 +1,41 @@
+"""Tests for micro-batching of /predict queries."""
+import asyncio
+import unittest
+
+from main import QueryBatcher
+
+
+class FailingBatchEngine:
+    """Engine whose batched path always fails and whose single path fails for "bad"."""
+    
+    def query_sequence_batch(self, sequences, top_ks):
+        raise RuntimeError("batch failed")
+    
+    def query_single_sequence(self, sequence, top_k):
+        if sequence == "bad":
+            raise ValueError("bad sequence")
+        return {"query_sequence": sequence, "top_k": top_k}
+
+
+class QueryBatcherTest(unittest.TestCase):
+    
+    def test_failed_batch_only_fails_bad_requests(self):
+        async def run():
+            batcher = QueryBatcher(FailingBatchEngine(), max_batch=8, max_wait_ms=50)
+            task = asyncio.create_task(batcher.run())
+            try:
+                return await asyncio.gather(
+                    *(batcher.submit(sequence, 5) for sequence in ["a", "bad", "b"]),
+                    return_exceptions=True
+                )
+            finally:
+                task.cancel()
+        
+        good_a, bad, good_b = asyncio.run(run())
+        self.assertEqual(good_a, {"query_sequence": "a", "top_k": 5})
+        self.assertEqual(good_b, {"query_sequence": "b", "top_k": 5})
+        self.assertIsInstance(bad, ValueError)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,82 @@
+"""Tests for saving and memory-mapping reference databases."""
+import os
+import tempfile
+import unittest
+
+import numpy as np
+
+from model.kmer import quantize_int8
+from search.database import ReferenceDatabase, scipy_sparse
+
+
+class MmapAlignmentTest(unittest.TestCase):
+    
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, "db.npz")
+    
+    def tearDown(self):
+        self.tmpdir.cleanup()
+    
+    def build(self, sparse=False):
+        db = ReferenceDatabase(k=6, sparse=sparse)
+        db.create_sample_database()
+        db.save(self.path, compress=False)
+        loaded = ReferenceDatabase(k=6, sparse=sparse)
+        self.assertTrue(loaded.load(self.path, mmap=True))
+        return db, loaded
+    
+    def test_dense_matrix_is_aligned(self):
+        db, loaded = self.build()
+        self.assertIsInstance(loaded.ref_matrix.base, np.memmap)
+        self.assertEqual(loaded.ref_matrix.ctypes.data % 16, 0)
+        np.testing.assert_array_equal(loaded.ref_matrix, db.ref_matrix)
+    
+    @unittest.skipIf(scipy_sparse is None, "scipy not installed")
+    def test_sparse_arrays_are_aligned(self):
+        db, loaded = self.build(sparse=True)
+        for array in (loaded.ref_matrix.data, loaded.ref_matrix.indices, loaded.ref_matrix.indptr):
+            self.assertEqual(array.ctypes.data % 16, 0)
+        self.assertEqual((loaded.ref_matrix != db.ref_matrix).nnz, 0)
+
+    
+    def test_quantized_copy_is_built_on_first_use(self):
+        db = ReferenceDatabase(k=6)
+        db.create_sample_database()
+        db.save(self.path, compress=False)
+        loaded = ReferenceDatabase(k=6, quantize=True)
+        loaded.load(self.path, mmap=True)
+        self.assertIsNone(loaded._ref_i8)
+        
+        ref_i8, scales = quantize_int8(db.ref_matrix)
+        np.testing.assert_array_equal(loaded.ref_i8_t, ref_i8.T)
+        np.testing.assert_array_equal(loaded.ref_i8_scales, scales)
+        self.assertIsNone(db.ref_i8_t)
+
+    def test_overwrite_keeps_existing_map_valid(self):
+        db, loaded = self.build()
+        before = np.array(loaded.ref_matrix)
+        db.save(self.path, compress=False)
+        np.testing.assert_array_equal(loaded.ref_matrix, before)
+        self.assertEqual(os.listdir(self.tmpdir.name), ["db.npz"])
+
+
+
+class RecordAccessTest(unittest.TestCase):
+    
+    def test_record_matches_sequences(self):
+        db = ReferenceDatabase(k=6, keep_sequences=True)
+        db.create_sample_database()
+        records = db.sequences
+        self.assertEqual(len(records), len(db))
+        for i, expected in enumerate(records):
+            for record in (db.record(i), db[i]):
+                self.assertEqual(record.sequence_id, expected.sequence_id)
+                self.assertEqual(record.sequence, expected.sequence)
+                np.testing.assert_array_equal(record.vector, expected.vector)
+        self.assertEqual(db[-1].sequence_id, records[-1].sequence_id)
+        self.assertEqual([record.sequence_id for record in db], [record.sequence_id for record in records])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,133 @@
+"""Tests for top_k handling in the query engine."""
+import os
+import tempfile
+import unittest
+
+import numpy as np
+
+from query.engine import SequenceQueryEngine, iter_fasta, top_k_indices, top_k_indices_batch
+from search.database import ReferenceDatabase, hnswlib, parse_fasta
+
+
+class TopKTest(unittest.TestCase):
+    
+    @classmethod
+    def setUpClass(cls):
+        cls.db = ReferenceDatabase(k=6)
+        cls.db.create_sample_database()
+        cls.sequence = "TACGTAGGGGGCAAGCGTTATCCGGATTTACTGGGTGTAAAGGGAGCGTAGACGG"
+        cls.fasta = f">q1\n{cls.sequence}\n"
+    
+    def setUp(self):
+        self.engine = SequenceQueryEngine(self.db)
+    
+    def query_all_paths(self, top_k):
+        """Match lists for the single, batched and FASTA query paths."""
+        single = self.engine.query_single_sequence(self.sequence, top_k)["results"]
+        self.engine.clear_cache()
+        batch = self.engine.query_sequence_batch([self.sequence], [top_k])[0]["results"]
+        fasta = self.engine.query_fasta_sequences(self.fasta, top_k)["results"][0]["matches"]
+        return single, batch, fasta
+    
+    def test_none_returns_every_match(self):
+        for matches in self.query_all_paths(None):
+            self.assertEqual(len(matches), len(self.db))
+    
+    def test_zero_returns_no_matches(self):
+        for matches in self.query_all_paths(0):
+            self.assertEqual(matches, [])
+    
+    def test_negative_is_rejected(self):
+        with self.assertRaises(ValueError):
+            self.engine.query_single_sequence(self.sequence, -1)
+        with self.assertRaises(ValueError):
+            self.engine.query_sequence_batch([self.sequence], [-1])
+        with self.assertRaises(ValueError):
+            self.engine.query_fasta_sequences(self.fasta, -1)
+    
+    def test_larger_than_database_is_clamped(self):
+        for matches in self.query_all_paths(len(self.db) + 10):
+            self.assertEqual(len(matches), len(self.db))
+    
+    def test_mixed_batch(self):
+        results = self.engine.query_sequence_batch([self.sequence] * 3, [None, 0, 2])
+        self.assertEqual([r["matches_found"] for r in results], [len(self.db), 0, 2])
+    
+    def test_top_k_indices_none(self):
+        scores = np.array([0.1, 0.9, 0.5], dtype=np.float32)
+        np.testing.assert_array_equal(top_k_indices(scores, None), [1, 2, 0])
+        np.testing.assert_array_equal(top_k_indices_batch(scores[None], None)[0], [1, 2, 0])
+
+    def test_batch_caches_only_sparse_vectors(self):
+        batch = self.engine.query_sequence_batch([self.sequence], [None])[0]["results"]
+        self.assertTrue(all(kind == "sparse" for kind, _ in self.engine.vectorizer._cache._data))
+        self.engine.clear_cache()
+        single = self.engine.query_single_sequence(self.sequence, None)["results"]
+        for a, b in zip(batch, single):
+            self.assertAlmostEqual(a["similarity_score"], b["similarity_score"], places=5)
+
+
+
+@unittest.skipIf(hnswlib is None, "hnswlib not installed")
+class AnnTopKTest(unittest.TestCase):
+    
+    @classmethod
+    def setUpClass(cls):
+        rng = np.random.default_rng(0)
+        cls.sequences = ["".join(rng.choice(list("ACGT"), 150)) for _ in range(1200)]
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "ref.fasta")
+            with open(path, "w") as f:
+                f.writelines(f">r{i}\n{seq}\n" for i, seq in enumerate(cls.sequences))
+            cls.db = ReferenceDatabase(k=6)
+            cls.db.create_from_fasta(path)
+        cls.db.build_index()
+    
+    def test_large_top_k_falls_back_to_exact(self):
+        engine = SequenceQueryEngine(self.db)
+        query = self.sequences[7][10:140]
+        n = len(self.db)
+        for top_k, expected in ((None, n), (n - 10, n - 10), (n + 10, n)):
+            self.assertEqual(engine.query_single_sequence(query, top_k)["matches_found"], expected)
+        results = engine.query_sequence_batch([query, self.sequences[3]], [None, 5])
+        self.assertEqual([r["matches_found"] for r in results], [len(self.db), 5])
+        fasta = engine.query_fasta_sequences(f">q\n{query}\n", None)
+        self.assertEqual(len(fasta["results"][0]["matches"]), len(self.db))
+    
+    def test_index_failure_falls_back_to_exact(self):
+        class FailingIndex:
+            ef = 50
+            
+            def knn_query(self, data, k):
+                raise RuntimeError("Cannot return the results in a contiguous 2D array")
+        
+        index, self.db.index = self.db.index, FailingIndex()
+        try:
+            engine = SequenceQueryEngine(self.db)
+            self.assertEqual(engine.query_single_sequence(self.sequences[7], 5)["results"][0]["sequence_id"], "r7")
+            matches = engine.query_sequence_batch([self.sequences[3]], [5])[0]["results"]
+            self.assertEqual(matches[0]["sequence_id"], "r3")
+        finally:
+            self.db.index = index
+    
+    def test_small_top_k_uses_index(self):
+        engine = SequenceQueryEngine(self.db)
+        matches = engine.query_single_sequence(self.sequences[7], 5)["results"]
+        self.assertEqual(matches[0]["sequence_id"], "r7")
+
+
+class FastaParsingTest(unittest.TestCase):
+    
+    def test_upload_and_file_parsers_agree(self):
+        content = "> id1 \r\nACGT\r\nAC\n\n>id2\tdesc\nTT GG\n>  \n"
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "q.fasta")
+            with open(path, "w", newline="") as f:
+                f.write(content)
+            from_file = parse_fasta(path)
+        self.assertEqual(list(iter_fasta(content)), from_file)
+        self.assertEqual(from_file[0], {"id": "id1", "seq": "ACGTAC"})
+
+
+if __name__ == "__main__":
+    unittest.main()